@@ -4,10 +4,12 @@
 from abc import ABC, abstractmethod
 from enum import Enum, auto
 from datetime import date, timedelta
-from typing import Union
+from functools import lru_cache
+from typing import Callable, Union
 import math
 
 import numpy as np
+import shapely
 from shapely.geometry import MultiPolygon
 from shapely.ops import transform
 from pyproj import Transformer, CRS
@@ -17,6 +19,21 @@ from geopandas import GeoDataFrame
 from eocalc.context import Pollutant, GNFR
 
 
+@lru_cache(maxsize=1)
+def _equal_earth_projection() -> Callable:
+    """Create transformation from WGS84 to Equal Earth projection (once, then re-use it)."""
+    # EPSG:4326 is the shapely default (WGS84), EPSG:8857 is the Equal earth projection
+    return Transformer.from_crs(CRS("EPSG:4326"), CRS("EPSG:8857"), always_xy=True).transform
+
+
+@lru_cache(maxsize=None)
+def _gnfr_table_template(pollutant: Pollutant) -> DataFrame:
+    """Create empty GNFR table for given pollutant once, callers need to work on a copy."""
+    cols = [f"{pollutant.name} emissions [kt]", "Umin [%]", "Umax [%]"]
+    return DataFrame(index=list(GNFR), columns=cols, data=np.nan).append(
+        DataFrame(index=["Totals"], columns=cols, data=np.nan))
+
+
 class Status(Enum):
     """Represent state of calculator."""
 
@@ -223,12 +240,9 @@ class EOEmissionCalculator(ABC):
 
     def _validate(self, region: MultiPolygon, period: DateRange, pollutant: Pollutant):
         """Check inputs to run() method. Raise ValueError in case of a problem."""
-        if not self.covers(region):
-            raise ValueError("Region not covered by emission estimation method!")
-        # EPSG:4326 is the shapely default (WGS84), EPSG:8857 is the Equal earth projection
-        projection = Transformer.from_crs(CRS("EPSG:4326"), CRS("EPSG:8857"), always_xy=True).transform
-        if transform(projection, region).area / 10**6 < self.minimum_area_size():
-            raise ValueError("Region too small!")
+        # Cheap checks first, only look at the region's geometry if everything else is fine
+        if not self.supports(pollutant):
+            raise ValueError(f"Pollutant {pollutant.name} not supported!")
 
         if len(period) < self.minimum_period_length():
             raise ValueError(f"Time span {period} too short (minimum is {self.minimum_period_length()} days)!")
@@ -237,8 +251,10 @@ class EOEmissionCalculator(ABC):
         if period.end > self.latest_end_date():
             raise ValueError(f"Method cannot be used for period ending on {period.end}!")
 
-        if not self.supports(pollutant):
-            raise ValueError(f"Pollutant {pollutant.name} not supported!")
+        if not self.covers(region):
+            raise ValueError("Region not covered by emission estimation method!")
+        if transform(_equal_earth_projection(), region).area / 10**6 < self.minimum_area_size():
+            raise ValueError("Region too small!")
 
     @staticmethod
     def _create_gnfr_table(pollutant: Pollutant) -> DataFrame:
@@ -257,9 +273,7 @@ class EOEmissionCalculator(ABC):
         DataFrame
             Table to be filled by calculation methods.
         """
-        cols = [f"{pollutant.name} emissions [kt]", "Umin [%]", "Umax [%]"]
-        return DataFrame(index=list(GNFR), columns=cols, data=np.nan).append(
-            DataFrame(index=["Totals"], columns=cols, data=np.nan))
+        return _gnfr_table_template(pollutant).copy()
 
     @staticmethod
     def _combine_uncertainties(values: Series, uncertainties: Series) -> float:
@@ -320,8 +334,6 @@ class EOEmissionCalculator(ABC):
         GeoDataFrame
             Data frame with cell features spanning the full region. Will contain at least one row.
         """
-        grid = {"type": "FeatureCollection", "features": []}
-
         min_long, min_lat, max_long, max_lat = region.bounds if not snap else (
             region.bounds[0] - region.bounds[0] % width,
             region.bounds[1] - region.bounds[1] % height,
@@ -329,18 +341,17 @@ class EOEmissionCalculator(ABC):
             region.bounds[3] + (height - region.bounds[3] % height if region.bounds[3] % height != 0 else 0)
         )
 
-        for lat in (min_lat + y * height for y in range(math.ceil((max_lat - min_lat) / height))):
-            for long in (min_long + x * width for x in range(math.ceil((max_long - min_long) / width))):
-                grid["features"].append({
-                    "type": "Feature",
-                    "properties": {"Center latitude [°]": f"{lat + height / 2}",
-                                   "Center longitude [°]": f"{long + width / 2}"} if include_center_cols else {},
-                    "geometry": {"type": "Polygon", "coordinates": [
-                        [(long, lat),
-                         (long + width, lat),
-                         (long + width, lat + height),
-                         (long, lat + height),
-                         (long, lat)]]}
-                })
-
-        return GeoDataFrame.from_features(grid, crs=crs)
+        # Lower left corner of each cell, row by row (all longitudes for the first latitude, then the next...)
+        lats = min_lat + np.arange(math.ceil((max_lat - min_lat) / height)) * height
+        longs = min_long + np.arange(math.ceil((max_long - min_long) / width)) * width
+        lat, long = np.repeat(lats, len(longs)), np.tile(longs, len(lats))
+
+        # Build all cell polygons in one go from an array of shape (cells, 5 corners, 2 coordinates)
+        grid = {"geometry": shapely.polygons(np.stack([
+            np.stack([long, long + width, long + width, long, long], axis=1),
+            np.stack([lat, lat, lat + height, lat + height, lat], axis=1)], axis=-1))}
+        if include_center_cols:
+            grid["Center latitude [°]"] = [f"{value}" for value in (lat + height / 2).tolist()]
+            grid["Center longitude [°]"] = [f"{value}" for value in (long + width / 2).tolist()]
+
+        return GeoDataFrame(grid, crs=crs)
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 """Random emission calculator."""
 
-import random
 from datetime import date
 
+import numpy
 from shapely.geometry import MultiPolygon, shape
 from pandas import DataFrame
 from geopandas import GeoDataFrame, overlay
@@ -12,6 +12,9 @@ from eocalc.context import Pollutant, GNFR
 from eocalc.methods.base import DateRange
 from eocalc.methods.base import Status, EOEmissionCalculator
 
+# Random number generator shared by all calculator instances
+_RNG = numpy.random.default_rng()
+
 
 class RandomEOEmissionCalculator(EOEmissionCalculator):
     """Implement the emission calculator returning random non-sense."""
@@ -51,8 +54,7 @@ class RandomEOEmissionCalculator(EOEmissionCalculator):
 
         # Generate data frame with random emission values per GNFR sector
         data = self._create_gnfr_table(pollutant)
-        for sector in GNFR:
-            data.loc[sector] = [random.random()*100, random.random()*18, random.random()*22]
+        data.iloc[:len(GNFR)] = _RNG.random((len(GNFR), 3)) * [100, 18, 22]
         # Add totals row at the bottom
         data.loc["Totals"] = data.sum(axis=0)
 
@@ -62,7 +64,7 @@ class RandomEOEmissionCalculator(EOEmissionCalculator):
         geo_data = self._create_grid(region, .1, .1, snap=False)
         geo_data = overlay(geo_data, GeoDataFrame({'geometry': [region]}, crs="EPSG:4326"), how='intersection')
         geo_data.insert(0, "Area [km²]", geo_data.to_crs(epsg=8857).area / 10 ** 6)  # Equal earth projection
-        geo_data.insert(1, f"Total {pollutant.name} emissions [kg]", [random.random()*100 for _ in range(len(geo_data))])
+        geo_data.insert(1, f"Total {pollutant.name} emissions [kg]", _RNG.random(len(geo_data)) * 100)
         geo_data.insert(2, "Umin [%]", 42)
         geo_data.insert(3, "Umax [%]", 42)
         geo_data.insert(4, "Number of values [1]", len(period))
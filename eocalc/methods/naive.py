@@ -2,13 +2,19 @@
 """Emission calculators based on TEMIS data (temis.nl)"""
 import os.path
 import shutil
+import socket
 import gzip
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import date, timedelta
-from urllib.request import urlretrieve
+from functools import lru_cache
+from urllib.error import ContentTooShortError, HTTPError, URLError
+from urllib.request import urlopen
 
 import numpy
-from pandas import DataFrame, Series
+from pandas import DataFrame, concat
 from shapely.geometry import MultiPolygon, shape
 from geopandas import GeoDataFrame, overlay
 
@@ -25,8 +31,25 @@ TEMIS_BIN_WIDTH = 0.125
 TEMIS_VALUES_PER_ROW = 20
 # TEMIS TOMS file invalid value placeholder
 TEMIS_NAN_VALUE = -999
+# TEMIS value to NO2 mass conversion factor [kg/km²]:
+# value [1/cm²] * TEMIS scale [1] / Avogadro constant [1] * NO2 molecule weight [g] / to [kg] * to [km²]
+TEMIS_TO_KG_PER_KM2 = 10**13 / (6.022 * 10**23) * 46.01 / 1000 * 10**10
 # Uncertainty value assumed per cell (TODO Use a proper/realistic value here!)
 TEMIS_CELL_UNCERTAINTY = 1000
+# Buffer size used to download and decompress TEMIS files [bytes]
+TEMIS_BUFFER_SIZE = 2**20
+# Maximum number of monthly TEMIS files to download at the same time
+TEMIS_MAX_PARALLEL_DOWNLOADS = 4
+# Number of retries for failed TEMIS downloads and initial delay between them, doubled for each retry [s]
+TEMIS_DOWNLOAD_RETRIES = 3
+TEMIS_DOWNLOAD_RETRY_DELAY = 2
+# HTTP status codes indicating a temporary problem, downloads failing with other codes are not retried
+TEMIS_DOWNLOAD_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Timeout for connecting to the TEMIS server and for each read from it [s]
+TEMIS_DOWNLOAD_TIMEOUT = 60
+
+# One lock per local data file, makes sure a file is not downloaded twice by concurrent threads
+_file_locks: dict[str, threading.Lock] = {}
 
 
 class TropomiMonthlyMeanAggregator(EOEmissionCalculator):
@@ -61,35 +84,40 @@ class TropomiMonthlyMeanAggregator(EOEmissionCalculator):
         self._state = Status.RUNNING
         self._progress = 0  # TODO Update progress below!
 
+        days = list(period)
+
         # 1. Overlay area given with cells matching the TEMIS data set
         grid = self._create_grid(region, TEMIS_BIN_WIDTH, TEMIS_BIN_WIDTH, snap=True, include_center_cols=True)
 
-        # 2. Read TEMIS data into the grid, use cache to avoid re-reading the file for each day individually
+        # 2. Make sure TEMIS data for all months covered is available, missing files are downloaded in parallel
+        months = {f"{day:%Y-%m}": day for day in days}
+        with ThreadPoolExecutor(max_workers=min(len(months), TEMIS_MAX_PARALLEL_DOWNLOADS)) as executor:
+            files = dict(zip(months.keys(), executor.map(self._assure_data_availability, months.values())))
+
+        # 3. Read TEMIS data once per month, then put it into the grid for each day of that month
         cache: dict[str, list[float]] = {}
-        for column, day in enumerate(period):
-            month_cache_key = f"{day:%Y-%m}"
-            if month_cache_key not in cache.keys():
-                concentrations = self._read_toms_data(region, self._assure_data_availability(day))
-                # value [1/cm²] * TEMIS scale [1] / Avogadro constant [1] * NO2 molecule weight [g] / to [kg] * to [km²]
-                cache[month_cache_key] = [x * 10**13 / (6.022 * 10**23) * 46.01 / 1000 * 10**10 for x in concentrations]
-                # TODO Correct for pollutant atmosphere lifetime and diurnal variation: pollutant.atmo_lifetime(day, latitude) * pollutant.diurnal_variation(day, instrument)
-
-            # Here, values are actually [kg/km²], but the area [km²] cancels out below
-            grid.insert(column, f"{day} {pollutant.name} emissions [kg]", cache[month_cache_key])
-
-        # 3. Clip to actual region and add a data frame column with each cell's size
+        for month, file in files.items():
+            cache[month] = [x * TEMIS_TO_KG_PER_KM2 for x in self._read_toms_data(region, file)]
+            # TODO Correct for pollutant atmosphere lifetime and diurnal variation: pollutant.atmo_lifetime(day, latitude) * pollutant.diurnal_variation(day, instrument)
+
+        # Here, values are actually [kg/km²], but the area [km²] cancels out below
+        columns = [f"{day} {pollutant.name} emissions [kg]" for day in days]
+        emissions = DataFrame({column: cache[f"{day:%Y-%m}"] for column, day in zip(columns, days)}, index=grid.index)
+        grid = GeoDataFrame(concat([emissions, grid], axis=1), crs=grid.crs)
+
+        # 4. Clip to actual region and add a data frame column with each cell's size
         grid = overlay(grid, GeoDataFrame({"geometry": [region]}, crs="EPSG:4326"), how="intersection")
         grid.insert(0, "Area [km²]", grid.to_crs(epsg=8857).area / 10 ** 6)  # Equal earth projection
 
-        # 4. Update emission columns by multiplying with the area value and sum it all up
-        grid.iloc[:, -(len(period)+3):-3] = grid.iloc[:, -(len(period)+3):-3].mul(grid["Area [km²]"], axis=0)
-        grid.insert(1, f"Total {pollutant.name} emissions [kg]", grid.iloc[:, -(len(period)+3):-3].sum(axis=1))
+        # 5. Update emission columns by multiplying with the area value and sum it all up
+        grid[columns] = grid[columns].mul(grid["Area [km²]"], axis=0)
+        grid.insert(1, f"Total {pollutant.name} emissions [kg]", grid[columns].sum(axis=1))
         grid.insert(2, "Umin [%]", self._calculate_row_uncertainties(grid, period))
         grid.insert(3, "Umax [%]", grid["Umin [%]"])
-        grid.insert(4, "Number of values [1]", len(period))
-        grid.insert(5, "Missing values [1]", grid.iloc[:, -(len(period)+3):-3].isna().sum(axis=1))
+        grid.insert(4, "Number of values [1]", len(days))
+        grid.insert(5, "Missing values [1]", grid[columns].isna().sum(axis=1))
 
-        # 5. Add GNFR table incl. uncertainties
+        # 6. Add GNFR table incl. uncertainties
         table = self._create_gnfr_table(pollutant)
         total_uncertainty = self._combine_uncertainties(grid.iloc[:, 1], grid.iloc[:, 2])
         table.iloc[-1] = [grid.iloc[:, 1].sum() / 10**6, total_uncertainty, total_uncertainty]
@@ -99,60 +127,115 @@ class TropomiMonthlyMeanAggregator(EOEmissionCalculator):
 
     @staticmethod
     def _read_toms_data(region: MultiPolygon, file: str) -> list[float]:
+        # Parsing is expensive, so re-use results for the same area as long as the file is not modified
+        return list(TropomiMonthlyMeanAggregator._read_toms_file(region.bounds, file, os.path.getmtime(file)))
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def _read_toms_file(bounds: tuple[float, float, float, float], file: str, modified: float) -> tuple[float, ...]:
         # TODO Make this work with regions wrapping around to long < -180 or long > 180? TODO more stuff!
-        min_lat, max_lat = region.bounds[1] - region.bounds[1] % TEMIS_BIN_WIDTH, region.bounds[3]
-        min_long, max_long = region.bounds[0] - region.bounds[0] % TEMIS_BIN_WIDTH,  region.bounds[2]
+        min_lat, max_lat = bounds[1] - bounds[1] % TEMIS_BIN_WIDTH, bounds[3]
+        min_long, max_long = bounds[0] - bounds[0] % TEMIS_BIN_WIDTH,  bounds[2]
 
-        result: list[float] = []
+        # Each latitude row covers -180° to 180°, pick the slice of longitudes we need
+        longs = -180 + numpy.arange(round(360 / TEMIS_BIN_WIDTH)) * TEMIS_BIN_WIDTH
+        first, last = numpy.searchsorted(longs, min_long), numpy.searchsorted(longs, max_long)
 
+        lines: list[str] = []
         with open(file, 'r') as data:
             lat = -91
             for line in data:
                 if line.startswith("lat="):
                     lat = float(line.split('=')[1]) - TEMIS_BIN_WIDTH / 2
-                    offset = -180  # We need to go from -180° to +180° for each latitude
-                elif min_lat <= lat < max_lat and line[:4].strip().lstrip('-').isdigit():
-                    for count, long in enumerate(offset + x * TEMIS_BIN_WIDTH for x in range(TEMIS_VALUES_PER_ROW)):
-                        if min_long <= long < max_long:
-                            emission = int(line[count * 4:count * 4 + 4])  # All emission values are four digits wide
-                            result += [emission] if emission > TEMIS_NAN_VALUE else [numpy.NaN]
-                    offset += TEMIS_VALUES_PER_ROW * TEMIS_BIN_WIDTH
+                elif min_lat <= lat < max_lat:
+                    row = line.rstrip()  # Values are right-aligned, trailing blanks are not part of them
+                    # Only take full data rows, parsing them as fixed-width fields relies on that
+                    if len(row) == TEMIS_VALUES_PER_ROW * 4 and row[:4].strip().lstrip('-').isdigit():
+                        lines.append(row)
 
-        return result
+        # All emission values are four digits wide, so parse them in one go as fixed-width fields
+        values = numpy.frombuffer("".join(lines).encode(), dtype="S4").astype(int).reshape(-1, len(longs))
+        values = values[:, first:last]
+        return tuple(numpy.where(values > TEMIS_NAN_VALUE, values, numpy.nan).ravel().tolist())
 
     @staticmethod
     def _assure_data_availability(day: date) -> str:
         def is_gz_file(filepath):
+            if not os.path.isfile(filepath):
+                return False
             with open(filepath, 'rb') as testfile:
                 return testfile.read(2) == b'\x1f\x8b'  # gzip 'magic number'
 
         file = f"{LOCAL_DATA_FOLDER}/no2_{day:%Y%m}.asc"
-
-        with threading.Lock():
-            if not os.path.isfile(f"{file}"):
-                if not os.path.isfile(f"{file}.original.gz"):
-                    # TODO Handle HTTP errors
-                    urlretrieve(TEMIS_DOWNLOAD_URL % (f"{day:%Y}", f"{day:%m}", f"{day:%Y%m}"), f"{file}.original.gz")
+        original = f"{file}.original.gz"
+
+        with _file_locks.setdefault(file, threading.Lock()):
+            if not os.path.isfile(file):
+                # Only re-use earlier downloads that are actual gzip files, not stored error pages or the like
+                if not is_gz_file(original):
+                    os.makedirs(LOCAL_DATA_FOLDER, exist_ok=True)
+                    TropomiMonthlyMeanAggregator._download(
+                        TEMIS_DOWNLOAD_URL % (f"{day:%Y}", f"{day:%m}", f"{day:%Y%m}"), original)
+                    if not is_gz_file(original):
+                        os.remove(original)
+                        raise ValueError(f"Download of TEMIS data for {day:%Y-%m} did not return a gzip file!")
 
                 # TODO Test this on different platforms, behaviours seem to differ!
-                with gzip.open(f"{file}.original.gz", 'rb') as compressed:
-                    with open(f"{file}.gz", 'wb') as uncompressed:
-                        shutil.copyfileobj(compressed, uncompressed)
-                if is_gz_file(f"{file}.gz"):
-                    with gzip.open(f"{file}.gz", 'rb') as compressed:
-                        with open(f"{file}", 'wb') as uncompressed:
-                            shutil.copyfileobj(compressed, uncompressed)
-                else:
-                    shutil.move(f"{file}.gz", f"{file}")
-
-                # TODO Remove downloaded/intermediate files?
+                try:
+                    with gzip.open(original, 'rb') as compressed:
+                        # Files might be compressed twice,
+                        # remove inner layer on the fly instead of via intermediate file
+                        double_compressed = compressed.read(2) == b'\x1f\x8b'  # gzip 'magic number'
+                        compressed.seek(0)
+                        with gzip.open(compressed, 'rb') if double_compressed else compressed as source:
+                            with open(f"{file}.part", 'wb') as uncompressed:
+                                shutil.copyfileobj(source, uncompressed, TEMIS_BUFFER_SIZE)
+                except BaseException:
+                    with suppress(FileNotFoundError):
+                        os.remove(f"{file}.part")
+                    raise
+                os.replace(f"{file}.part", file)
+
+                # TODO Remove downloaded file?
 
         return file
 
+    @staticmethod
+    def _download(url: str, file: str) -> None:
+        # TODO Handle HTTP errors (other than the transient ones retried below)
+        try:
+            for attempt in range(TEMIS_DOWNLOAD_RETRIES + 1):
+                try:
+                    # Download to temporary file first, an interrupted download must not count as existing file
+                    with urlopen(url, timeout=TEMIS_DOWNLOAD_TIMEOUT) as response, \
+                            open(f"{file}.part", 'wb') as download:
+                        shutil.copyfileobj(response, download, TEMIS_BUFFER_SIZE)
+                        if download.tell() < int(response.headers.get("Content-Length", 0)):
+                            raise ContentTooShortError(f"Download of {url} incomplete!", None)
+                    break
+                except (URLError, ConnectionError, TimeoutError, socket.timeout) as error:
+                    # Only retry temporary problems, bad URLs, unknown hosts etc. will not go away by waiting
+                    if isinstance(error, HTTPError):
+                        transient = error.code in TEMIS_DOWNLOAD_RETRY_STATUS_CODES
+                    elif isinstance(error, URLError):
+                        transient = isinstance(error, ContentTooShortError) or \
+                            isinstance(error.reason, (ConnectionError, TimeoutError, socket.timeout))
+                    else:  # Raised while reading, socket.timeout is no TimeoutError before Python 3.10
+                        transient = True
+                    if not transient or attempt == TEMIS_DOWNLOAD_RETRIES:
+                        raise
+                    time.sleep(TEMIS_DOWNLOAD_RETRY_DELAY * 2 ** attempt)
+        except BaseException:
+            # Do not leave partial downloads behind, whatever made them fail
+            with suppress(FileNotFoundError):
+                os.remove(f"{file}.part")
+            raise
+
+        os.replace(f"{file}.part", file)
+
     def _calculate_row_uncertainties(self, grid, period) -> list[float]:
-        # TODO It would be great to make this faster using clever iteration/numpy/CPython
-        uncertainties = Series([TEMIS_CELL_UNCERTAINTY] * len(period))
-        return [
-            self._combine_uncertainties(row[-(len(period) + 3):-3], uncertainties)
-            for _, row in grid.iterrows()
-        ]
+        # Same as _combine_uncertainties() applied to each row's emission values, but for all rows at once
+        values = grid.iloc[:, -(len(period) + 3):-3].to_numpy(dtype=float)
+        totals = numpy.nansum(numpy.abs(values), axis=1)
+        combined = numpy.nansum((values * TEMIS_CELL_UNCERTAINTY) ** 2, axis=1) ** 0.5
+        return numpy.divide(combined, totals, out=numpy.zeros_like(totals), where=totals != 0).tolist()
@@ -269,6 +269,13 @@ class TestCalcMethods:
             assert frame.iloc[:, 1].name.startswith("Umin")
             assert frame.iloc[:, 2].name.startswith("Umax")
 
+    def test_create_gnfr_frame_independent_copies(self, calc):
+        frame = calc._create_gnfr_table(Pollutant.NO2)
+        frame.iloc[-1] = [1, 2, 3]
+
+        assert calc._create_gnfr_table(Pollutant.NO2).isna().all(axis=None)
+        assert frame is not calc._create_gnfr_table(Pollutant.NO2)
+
     @pytest.mark.parametrize(
         "values, uncertainties, result", [
             (Series(10), Series(2), 2),
@@ -370,3 +377,11 @@ class TestCalcMethods:
         ])
     def test_create_grid_well_known(self, calc, width, height, snap, region_small_but_well_known, cell_count):
         assert cell_count == len(calc._create_grid(region_small_but_well_known, width, height, snap=snap))
+
+    def test_create_grid_cell_geometry(self, calc, region_box_north_of_equator):
+        grid = calc._create_grid(region_box_north_of_equator, 0.5, 0.25, include_center_cols=True)
+        assert ["geometry", "Center latitude [°]", "Center longitude [°]"] == list(grid.columns)
+        assert [(0., 0.), (0.5, 0.), (0.5, 0.25), (0., 0.25), (0., 0.)] == list(grid.geometry.iloc[0].exterior.coords)
+        assert [(0.5, 0.75), (1., 0.75), (1., 1.), (0.5, 1.), (0.5, 0.75)] == list(grid.geometry.iloc[-1].exterior.coords)
+        assert ("0.125", "0.25") == (grid.iloc[0, 1], grid.iloc[0, 2])
+        assert ("0.875", "0.75") == (grid.iloc[-1, 1], grid.iloc[-1, 2])
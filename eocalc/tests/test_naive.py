@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 import pytest
+import gzip
 import json
 import os
+import socket
 from datetime import date, timedelta
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
 
+import numpy
+from pandas import DataFrame, Series
 from shapely.geometry import shape
 
 from eocalc.context import Pollutant
 from eocalc.methods.base import DateRange
+import eocalc.methods.naive
 from eocalc.methods.naive import TropomiMonthlyMeanAggregator, LOCAL_DATA_FOLDER
 
 from eocalc.tests.test_base import region_sample_north, region_sample_south, region_sample_span_equator
@@ -53,6 +60,32 @@ def region_small_but_well_known_third():
                   "coordinates": [[[[179.79, 47.188], [179.995, 47.188], [179.995, 47.187]]]]})
 
 
+@pytest.fixture
+def flaky_urlopen(monkeypatch):
+    """Make urlopen() fail with the errors in "failures" before succeeding, record all calls made.
+
+    URL errors are raised by urlopen() itself, all others when reading the response.
+    """
+    def flaky(url, timeout=None):
+        flaky.calls.append(url)
+        response = urlopen(url, timeout=timeout)
+        if len(flaky.calls) <= len(flaky.failures):
+            error = flaky.failures[len(flaky.calls) - 1]
+            if isinstance(error, URLError):
+                response.close()
+                raise error
+
+            def read(*args):
+                raise error
+            response.read = read
+        return response
+
+    flaky.calls, flaky.failures = [], []
+    monkeypatch.setattr(eocalc.methods.naive, "urlopen", flaky)
+    monkeypatch.setattr(eocalc.methods.naive, "TEMIS_DOWNLOAD_RETRY_DELAY", 0)
+    return flaky
+
+
 class TestTropomiMonthlyMeanAggregatorMethods:
 
     @pytest.mark.parametrize("region", ["region_sample_north", "region_sample_south", "region_sample_span_equator"])
@@ -108,6 +141,42 @@ class TestTropomiMonthlyMeanAggregatorMethods:
     def test_read_toms_data(self, calc, file, region, result, request):
         assert result == calc._read_toms_data(request.getfixturevalue(region), request.getfixturevalue(file))
 
+    def test_read_toms_data_skips_non_data_lines(self, calc, clipped_data_file_name, tmp_path):
+        region = shape({"type": "MultiPolygon",
+                        "coordinates": [[[[10., 58.], [10.3, 58.], [10.3, 58.1], [10., 58.1], [10., 58.]]]]})
+        with open(clipped_data_file_name, 'r') as clipped:
+            lines = clipped.readlines()
+        expected = calc._read_toms_data(region, clipped_data_file_name)
+
+        # Trailing blanks on data rows, blank and other non-data lines inside a latitude block and at the end
+        lines[-1] = lines[-1].rstrip("\n") + "  \n"
+        lines[-20] = lines[-20].rstrip("\n") + " \t \r\n"
+        lines.insert(-10, "\n")
+        lines.insert(-5, "some comment\n")
+        lines.append("\n")
+        file = tmp_path / "no2_201808_modified.asc"
+        file.write_text("".join(lines))
+
+        assert 3 == len(expected)
+        assert expected == calc._read_toms_data(region, str(file))
+
+    def test_read_toms_data_cached(self, calc, clipped_data_file_name, region_small_but_well_known):
+        first = calc._read_toms_data(region_small_but_well_known, clipped_data_file_name)
+        hits = calc._read_toms_file.cache_info().hits
+        first.append(42)  # Results handed out must not alter the cache
+
+        assert [133, 186, 189, 304, 272, 294] == calc._read_toms_data(region_small_but_well_known, clipped_data_file_name)
+        assert hits + 1 == calc._read_toms_file.cache_info().hits
+
+    def test_calculate_row_uncertainties(self, calc):
+        period = DateRange(start='2020-02-28', end='2020-03-01')
+        grid = DataFrame({"Area [km²]": [1, 2, 3, 4], "Total [kg]": [0, 0, 0, 0],
+                          "Day 1": [10, numpy.nan, 0, numpy.nan], "Day 2": [20, 5, 0, numpy.nan],
+                          "Day 3": [-5, 2, 0, numpy.nan], "geometry": None, "Lat": 0, "Long": 0})
+        expected = [calc._combine_uncertainties(row[-6:-3], Series([1000] * 3)) for _, row in grid.iterrows()]
+
+        assert expected == pytest.approx(calc._calculate_row_uncertainties(grid, period))
+
     def test_assure_data_availability(self, calc):
         day = date.fromisoformat("2018-09-15")
         file = calc._assure_data_availability(day)
@@ -115,3 +184,64 @@ class TestTropomiMonthlyMeanAggregatorMethods:
 
         os.remove(file)
         assert f"{LOCAL_DATA_FOLDER}/no2_201809.asc" == calc._assure_data_availability(day)
+
+    def test_assure_data_availability_bad_download(self, calc, tmp_path, monkeypatch):
+        day = date.fromisoformat("2018-08-15")
+        monkeypatch.setattr(eocalc.methods.naive, "LOCAL_DATA_FOLDER", str(tmp_path))
+        stub = tmp_path / "no2_201808.asc.original.gz"
+        stub.write_text("<html>Service unavailable</html>")
+        (tmp_path / "server" / "2018" / "08").mkdir(parents=True)
+        (tmp_path / "server" / "2018" / "08" / "no2_201808.asc.gz").write_text("<html>Not a gzip file</html>")
+        monkeypatch.setattr(eocalc.methods.naive, "TEMIS_DOWNLOAD_URL", f"file://{tmp_path}/server/%s/%s/no2_%s.asc.gz")
+
+        # Bad earlier download is not re-used, bad new download is rejected and removed
+        with pytest.raises(ValueError):
+            calc._assure_data_availability(day)
+        assert not stub.exists()
+        assert not (tmp_path / "no2_201808.asc").exists()
+
+    def test_assure_data_availability_broken_archive(self, calc, tmp_path, monkeypatch):
+        day = date.fromisoformat("2018-08-15")
+        monkeypatch.setattr(eocalc.methods.naive, "LOCAL_DATA_FOLDER", str(tmp_path))
+        # Earlier download with correct gzip header, but cut off
+        (tmp_path / "no2_201808.asc.original.gz").write_bytes(gzip.compress(os.urandom(10000))[:5000])
+
+        with pytest.raises(EOFError):
+            calc._assure_data_availability(day)
+        assert not (tmp_path / "no2_201808.asc").exists()
+        assert not (tmp_path / "no2_201808.asc.part").exists()
+
+    @pytest.mark.parametrize("failures, attempts", [
+        ([], 1),
+        ([HTTPError("url", 503, "Failed", None, None)], 2),
+        ([HTTPError("url", 429, "Failed", None, None)] * 3, 4),
+        ([URLError(ConnectionResetError())], 2),
+        ([URLError(socket.timeout())], 2),
+        ([socket.timeout()], 2),
+        ([ConnectionResetError()], 2)
+    ])
+    def test_download_retries(self, calc, clipped_data_file_name, tmp_path, flaky_urlopen, failures, attempts):
+        flaky_urlopen.failures.extend(failures)
+        target = str(tmp_path / "download.asc")
+
+        calc._download(f"file://{os.path.abspath(clipped_data_file_name)}", target)
+        with open(target, 'rb') as downloaded, open(clipped_data_file_name, 'rb') as original:
+            assert original.read() == downloaded.read()
+        assert attempts == len(flaky_urlopen.calls)
+
+    @pytest.mark.parametrize("failures, attempts", [
+        ([HTTPError("url", 404, "Failed", None, None)], 1),
+        ([HTTPError("url", 503, "Failed", None, None)] * 4, 4),
+        ([URLError(socket.gaierror())], 1),
+        ([URLError("unknown url type")], 1),
+        ([socket.timeout()] * 4, 4)
+    ])
+    def test_download_fails(self, calc, clipped_data_file_name, tmp_path, flaky_urlopen, failures, attempts):
+        flaky_urlopen.failures.extend(failures)
+        target = str(tmp_path / "download.asc")
+
+        with pytest.raises(type(failures[-1])):
+            calc._download(f"file://{os.path.abspath(clipped_data_file_name)}", target)
+        assert not os.path.exists(target)
+        assert not os.path.exists(f"{target}.part")
+        assert attempts == len(flaky_urlopen.calls)